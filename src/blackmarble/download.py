@@ -1,6 +1,12 @@
 import asyncio
 import datetime
+import hashlib
 import json
+import logging
+import os
+import re
+import uuid
+from contextlib import contextmanager
 from dataclasses import dataclass
 from importlib.resources import files
 from pathlib import Path
@@ -12,11 +18,24 @@ import httpx
 import nest_asyncio
 import pandas as pd
 from httpx import HTTPError
-from pqdm.threads import pqdm
 from pydantic import BaseModel
 from tqdm.auto import tqdm
 from .types import Product
 
+logger = logging.getLogger(__name__)
+
+# Tile identifier embedded in Black Marble filenames, e.g. ``VNP46A2.A2023001.h21v06.001.2023010000000.h5``
+TILE_ID = re.compile(r"\.(h\d{2}v\d{2})\.")
+
+# Conservative delays after a date (the start of the period for monthly and annual
+# products) before all of its granules are published, so that its manifest is complete
+PUBLICATION_LAG = {
+    Product.VNP46A1: datetime.timedelta(days=30),
+    Product.VNP46A2: datetime.timedelta(days=60),
+    Product.VNP46A3: datetime.timedelta(days=120),
+    Product.VNP46A4: datetime.timedelta(days=550),
+}
+
 
 def chunks(ls, n):
     """Yield successive n-sized chunks from list."""
@@ -39,6 +58,30 @@ async def get_url(client, url, params):
     return await client.get(url, params=params)
 
 
+def _is_client_error(e: HTTPError):
+    """Whether the request failed on a client error (4xx), which retrying cannot fix"""
+    return isinstance(e, httpx.HTTPStatusError) and e.response.is_client_error
+
+
+@contextmanager
+def _write_then_replace(path: Path, mode: str = "w"):
+    """Write to a unique temporary file beside ``path``, moved into place once complete
+
+    An interrupted write leaves neither a truncated ``path`` nor its temporary file
+    behind, and concurrent writers of the same ``path``, e.g. processes sharing a
+    cache directory, never write to the same temporary file.
+    """
+    # Unlike NamedTemporaryFile, open creates the file with the usual permissions
+    partial = path.with_name(f"{path.name}.{uuid.uuid4().hex}.part")
+    try:
+        with open(partial, mode) as f:
+            yield f
+        os.replace(partial, path)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+
+
 @dataclass
 class BlackMarbleDownloader(BaseModel):
     """A downloader to retrieve `NASA Black Marble <https://blackmarble.gsfc.nasa.gov>`_ data.
@@ -56,7 +99,8 @@ class BlackMarbleDownloader(BaseModel):
     directory: Path
 
     TILES: ClassVar[geopandas.GeoDataFrame] = geopandas.read_file(
-        files("blackmarble.data").joinpath("blackmarbletiles.geojson")
+        files("blackmarble.data").joinpath("blackmarbletiles.geojson"),
+        engine="pyogrio",
     )
     URL: ClassVar[str] = "https://ladsweb.modaps.eosdis.nasa.gov"
 
@@ -64,11 +108,65 @@ class BlackMarbleDownloader(BaseModel):
         nest_asyncio.apply()
         super().__init__(bearer=bearer, directory=directory)
 
+    async def _query_files(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        params: dict,
+        skip_if_exists: bool = True,
+        cache_response: bool = True,
+    ):
+        """Query the NASA LAADS files API, caching non-empty responses in ``directory``
+
+        Parameters
+        ----------
+        skip_if_exists: bool, default=True
+            Whether to reuse a response previously cached in ``directory``
+
+        cache_response: bool, default=True
+            Whether the response may be cached, i.e. whether all the files it lists have been published
+
+        Returns
+        -------
+        dict
+            Files matching the query, keyed by file identifier, or ``None`` if the query failed or its response is not a list of files
+        """
+        key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        cache = Path(self.directory, "manifest", f"{key}.json")
+        if cache_response and skip_if_exists and cache.exists():
+            return json.loads(cache.read_text())
+
+        r = await get_url(client, url, params)
+        try:
+            content = r.json()
+        except json.decoder.JSONDecodeError:
+            return None
+
+        # Error bodies, such as {"error": "Service Unavailable"}, are JSON too, and
+        # must neither be cached nor mistaken for files
+        if not r.is_success or not (
+            isinstance(content, dict)
+            and all(isinstance(f, dict) for f in content.values())
+        ):
+            logger.warning(f"Manifest query {params} failed: {r.status_code} {content}")
+            return None
+
+        # Empty results are not cached, since the files may not have been published yet
+        if cache_response and content:
+            cache.parent.mkdir(exist_ok=True)
+            # Written aside then renamed, so that an interrupted write leaves no
+            # truncated response to be reused
+            with _write_then_replace(cache) as f:
+                f.write(json.dumps(content))
+
+        return content
+
     async def get_manifest(
         self,
         gdf: geopandas.GeoDataFrame,
         product_id: Product,
         date_range: datetime.date | List[datetime.date],
+        skip_if_exists: bool = True,
     ) -> pd.DataFrame:
         """Retrieve NASA Black Marble data manifest. i.d., download links.
 
@@ -80,6 +178,9 @@ class BlackMarbleDownloader(BaseModel):
         date_range: datetime.date | List[datetime.date]
             Date range for which to retrieve NASA Black Marble data manifest
 
+        skip_if_exists: bool, default=True
+            Whether to reuse manifest responses previously cached in ``directory``. Responses are only cached once every date they cover is older than the product's ``PUBLICATION_LAG``.
+
         Returns
         -------
         pandas.DataFrame
@@ -91,23 +192,39 @@ class BlackMarbleDownloader(BaseModel):
             product_id = Product(product_id)
 
         # Create bounding box
-        gdf = pd.concat([gdf, gdf.bounds], axis="columns").round(2)
-        gdf["bbox"] = gdf.round(2).apply(
-            lambda row: f"x{row.minx}y{row.miny},x{row.maxx}y{row.maxy}", axis=1
-        )
-
-        async with httpx.AsyncClient(verify=False) as client:
+        bounds = gdf.bounds.round(2).astype(str)
+        lower_left = "x" + bounds.minx + "y" + bounds.miny
+        upper_right = "x" + bounds.maxx + "y" + bounds.maxy
+        bboxes = (lower_left + "," + upper_right).tolist()
+
+        # Bound the number of concurrent queries; queued requests wait for a free
+        # connection (pool=None) instead of timing out and being retried
+        async with httpx.AsyncClient(
+            verify=False,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+            timeout=httpx.Timeout(60.0, pool=None),
+        ) as client:
+            url = f"{self.URL}/api/v1/files"
+            # Responses covering dates whose granules may still be published are
+            # incomplete, so they are neither cached nor read from the cache
+            published = datetime.date.today() - PUBLICATION_LAG[product_id]
             tasks = []
             for chunk in chunks(date_range, 250):
-                for _, row in gdf.iterrows():
-                    url = f"{self.URL}/api/v1/files"
+                cache_response = max(chunk) <= published
+                for bbox in bboxes:
                     params = {
                         "product": product_id.value,
                         "collection": "5000",
                         "dateRanges": f"{min(chunk)}..{max(chunk)}",
-                        "areaOfInterest": row["bbox"],
+                        "areaOfInterest": bbox,
                     }
-                    tasks.append(asyncio.ensure_future(get_url(client, url, params)))
+                    tasks.append(
+                        asyncio.ensure_future(
+                            self._query_files(
+                                client, url, params, skip_if_exists, cache_response
+                            )
+                        )
+                    )
 
             responses = [
                 await f
@@ -118,30 +235,38 @@ class BlackMarbleDownloader(BaseModel):
                 )
             ]
 
-            rs = []
-            for r in responses:
-                try:
-                    rs.append(pd.DataFrame(r.json()).T)
-                except json.decoder.JSONDecodeError:
-                    continue
+            rs = [pd.DataFrame(r).T for r in responses if r is not None]
 
             return pd.concat(rs)
 
     @backoff.on_exception(
         backoff.expo,
         HTTPError,
+        giveup=_is_client_error,
     )
-    def _download_file(
+    async def _download_file(
         self,
+        client: httpx.AsyncClient,
+        semaphore: asyncio.Semaphore,
         name: str,
+        skip_if_exists: bool = True,
     ):
         """Download NASA Black Marble file
 
         Parameters
         ----------
+        client: httpx.AsyncClient
+            HTTP client shared across downloads
+
+        semaphore: asyncio.Semaphore
+            Bounds the number of concurrent downloads
+
         names: str
              NASA Black Marble filename
 
+        skip_if_exists: bool, default=True
+            Whether to skip downloading data if file already exists
+
         Returns
         -------
         filename: pathlib.Path
@@ -150,25 +275,54 @@ class BlackMarbleDownloader(BaseModel):
         url = f"{self.URL}{name}"
         name = name.split("/")[-1]
 
-        with open(filename := Path(self.directory, name), "wb+") as f:
-            with httpx.stream(
-                "GET",
-                url,
-                headers={"Authorization": f"Bearer {self.bearer}"},
-            ) as response:
-                total = int(response.headers["Content-Length"])
-                with tqdm(
-                    total=total,
-                    unit="B",
-                    unit_scale=True,
-                    leave=None,
-                ) as pbar:
-                    pbar.set_description(f"Retrieving {name}...")
-                    for chunk in response.iter_raw():
+        filename = Path(self.directory, name)
+        if skip_if_exists:
+            try:
+                if filename.stat().st_size > 0:
+                    logger.debug(f"Skipping {name}, already downloaded")
+                    return filename
+            except FileNotFoundError:
+                pass
+
+        # Download to a partial file and move it into place once complete, so an
+        # interrupted transfer is never mistaken for a finished download
+        async with semaphore:
+            async with client.stream("GET", url) as response:
+                response.raise_for_status()
+                # Writes are blocking, so write in large chunks to keep the event loop
+                # free for the other transfers
+                with _write_then_replace(filename, "wb") as f:
+                    async for chunk in response.aiter_raw(chunk_size=1 << 20):
                         f.write(chunk)
-                        pbar.update(len(chunk))
 
-                return filename
+        return filename
+
+    async def _download_files(self, names: List[str], skip_if_exists: bool = True):
+        """Download NASA Black Marble files concurrently
+
+        Returns
+        -------
+        list
+            Filename of each downloaded file, or the exception raised while downloading it
+        """
+        semaphore = asyncio.Semaphore(16)
+
+        # Share one connection pool (and its TLS sessions) across all downloads
+        async with httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {self.bearer}"},
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+            timeout=60.0,
+        ) as client:
+            with tqdm(total=len(names), desc="Downloading...") as pbar:
+                tasks = []
+                for name in names:
+                    task = asyncio.ensure_future(
+                        self._download_file(client, semaphore, name, skip_if_exists)
+                    )
+                    task.add_done_callback(lambda _: pbar.update())
+                    tasks.append(task)
+
+                return await asyncio.gather(*tasks, return_exceptions=True)
 
     def download(
         self,
@@ -193,21 +347,31 @@ class BlackMarbleDownloader(BaseModel):
         skip_if_exists: bool, default=True
             Whether to skip downloading data if file already exists
         """
-        gdf = geopandas.overlay(
-            gdf.to_crs("EPSG:4326").dissolve(), self.TILES, how="intersection"
+        # Only the tiles intersecting the region of interest are needed, not their
+        # intersections, so query the spatial index rather than overlaying geometries
+        roi = gdf.to_crs("EPSG:4326").unary_union
+        tiles = self.TILES.iloc[self.TILES.sindex.query(roi, predicate="intersects")]
+        # Tiles merely sharing an edge with the region of interest hold none of its pixels
+        tiles = tiles[~tiles.touches(roi)]
+
+        bm_files_df = asyncio.run(
+            self.get_manifest(tiles, product_id, date_range, skip_if_exists)
         )
-
-        bm_files_df = asyncio.run(self.get_manifest(gdf, product_id, date_range))
         bm_files_df = bm_files_df[
-            bm_files_df["name"].str.contains("|".join(gdf["TileID"]))
+            bm_files_df["name"]
+            .str.extract(TILE_ID, expand=False)
+            .isin(set(tiles["TileID"]))
         ]
-        names = bm_files_df["fileURL"].tolist()
-
-        args = [(name,) for name in names]
-        return pqdm(
-            args,
-            self._download_file,
-            n_jobs=16,
-            argument_type="args",
-            desc="Downloading...",
-        )
+        # Queries cover whole tiles, so the same granule may come back from several
+        names = bm_files_df["fileURL"].drop_duplicates().tolist()
+
+        results = asyncio.run(self._download_files(names, skip_if_exists))
+
+        pathnames = []
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to download {name}: {result}")
+            else:
+                pathnames.append(result)
+
+        return pathnames
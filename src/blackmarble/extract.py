@@ -1,20 +1,209 @@
 import datetime
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
 from pathlib import Path
 from typing import List, Optional
 
 import geopandas
 import numpy as np
 import pandas as pd
-from rasterstats import zonal_stats
+import shapely
+from rasterio.features import rasterize
+from rasterio.transform import Affine
 
 from .raster import VARIABLE_DEFAULT, bm_raster, transform
 from .types import Product
 
+GROUPBY_STATS = {"count", "min", "max", "mean", "sum", "std", "median", "range"}
+BLOCK_ROWS = 512
+# Beyond this many groups of mutually overlapping features, rasterstats' per-feature
+# windows beat one label grid per group
+MAX_LABEL_GROUPS = 8
+
+
+def _partial_stats(labels: np.ndarray, values: np.ndarray, n: int):
+    """Reduce a block of pixels into per-zone partial aggregates
+
+    Returns
+    -------
+    dict
+        ``count``, ``sum``, ``mean``, ``m2`` (sum of squared deviations from the mean), ``min`` and ``max`` arrays, indexed by zone from ``0`` to ``n``
+    """
+    mask = (labels > 0) & ~np.isnan(values)
+    zones = labels[mask]
+    v = values[mask].astype(np.float64)
+
+    # Each aggregate is a single unbuffered pass over the pixels, indexed by zone
+    count = np.bincount(zones, minlength=n + 1)
+    total = np.bincount(zones, weights=v, minlength=n + 1)
+    mean = np.divide(total, count, out=np.zeros(n + 1), where=count > 0)
+    minimum = np.full(n + 1, np.inf)
+    np.minimum.at(minimum, zones, v)
+    maximum = np.full(n + 1, -np.inf)
+    np.maximum.at(maximum, zones, v)
+    return {
+        "count": count,
+        "sum": total,
+        "mean": mean,
+        # Squared deviations from the mean rather than raw squares, whose difference
+        # cancels catastrophically for bright, uniform zones
+        "m2": np.bincount(zones, weights=(v - mean[zones]) ** 2, minlength=n + 1),
+        "min": minimum,
+        "max": maximum,
+    }
+
+
+def _combine_stats(a: dict, b: dict):
+    """Combine the partial aggregates of two blocks, updating ``mean`` and ``m2`` pairwise as in Chan et al."""
+    count = a["count"] + b["count"]
+    delta = b["mean"] - a["mean"]
+    # Share of each zone's pixels that are in the second block; the cross term below
+    # vanishes unless the zone has pixels in both blocks
+    share = np.divide(b["count"], count, out=np.zeros(count.shape), where=count > 0)
+    return {
+        "count": count,
+        "sum": a["sum"] + b["sum"],
+        "mean": a["mean"] + delta * share,
+        "m2": a["m2"] + b["m2"] + delta**2 * a["count"] * share,
+        "min": np.minimum(a["min"], b["min"]),
+        "max": np.maximum(a["max"], b["max"]),
+    }
+
+
+def _overlap_groups(geometry: geopandas.GeoSeries):
+    """Assign each feature to a group in which no two features overlap
+
+    Returns
+    -------
+    numpy.ndarray
+        Group of each feature, from ``0``
+    """
+    left, right = geometry.sindex.query(geometry, predicate="intersects")
+    geoms = np.asarray(geometry)
+    # Features sharing only a boundary do not compete for any pixel
+    overlap = (left != right) & ~shapely.touches(geoms[left], geoms[right])
+
+    neighbours = [[] for _ in range(len(geometry))]
+    for i, j in zip(left[overlap], right[overlap]):
+        neighbours[i].append(j)
+
+    # Greedily give each feature the first group none of its overlapping features took
+    group = np.zeros(len(geometry), dtype=int)
+    for i, js in enumerate(neighbours):
+        taken = {group[j] for j in js if j < i}
+        group[i] = next(g for g in range(len(taken) + 1) if g not in taken)
+    return group
+
+
+def _rasterize_window(
+    geometry: geopandas.GeoSeries, zones: np.ndarray, affine: Affine, shape: tuple
+):
+    """Label the pixels of features with their zones, only over the window covering them
+
+    Returns
+    -------
+    tuple
+        Window of the raster, as a pair of slices, and the labels of its pixels
+    """
+    valid = ~(geometry.isna() | geometry.is_empty).to_numpy()
+    height, width = shape
+    row_start, row_stop, col_start, col_stop = 0, 1, 0, 1
+    if valid.any():
+        minx, miny, maxx, maxy = geometry[valid].total_bounds
+        (x0, x1), (y0, y1) = zip(
+            *(~affine * (x, y) for x, y in [(minx, maxy), (maxx, miny)])
+        )
+        col_start, col_stop = int(np.floor(min(x0, x1))), int(np.ceil(max(x0, x1)))
+        row_start, row_stop = int(np.floor(min(y0, y1))), int(np.ceil(max(y0, y1)))
+    # Keep at least one pixel within the raster, so that features off the raster
+    # still reduce to empty statistics
+    col_start = min(max(col_start, 0), width - 1)
+    row_start = min(max(row_start, 0), height - 1)
+    col_stop = min(max(col_stop, col_start + 1), width)
+    row_stop = min(max(row_stop, row_start + 1), height)
+
+    labels = np.zeros((row_stop - row_start, col_stop - col_start), dtype="uint32")
+    if valid.any():
+        labels = rasterize(
+            zip(geometry[valid], zones[valid]),
+            out=labels,
+            transform=affine * Affine.translation(col_start, row_start),
+        )
+    return np.s_[row_start:row_stop, col_start:col_stop], labels
+
+
+def _zonal_stats(labels: np.ndarray, values: np.ndarray, n: int, stats: List[str]):
+    """Compute zonal statistics over a raster whose pixels are labelled by zone
+
+    Parameters
+    ----------
+    labels: numpy.ndarray
+        Zone of each pixel, from ``1`` to ``n`` (``0`` for pixels outside any zone)
+
+    values: numpy.ndarray
+        Pixel values, aligned with ``labels``
+
+    n: int
+        Number of zones
+
+    stats: List[str]
+        Statistics to calculate, among ``GROUPBY_STATS``
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per zone and one column per statistic
+    """
+    results = {}
+    if "median" in stats:
+        mask = (labels > 0) & ~np.isnan(values)
+        grouped = pd.Series(values[mask]).groupby(labels[mask])
+
+        for stat in stats:
+            match stat:
+                case "std":
+                    results[stat] = grouped.std(ddof=0)
+                case "range":
+                    results[stat] = grouped.max() - grouped.min()
+                case _:
+                    results[stat] = getattr(grouped, stat)()
+    else:
+        # Every other statistic derives from partial aggregates, so row blocks are reduced concurrently
+        with ThreadPoolExecutor() as executor:
+            partials = list(
+                executor.map(
+                    lambda i: _partial_stats(
+                        labels[i : i + BLOCK_ROWS], values[i : i + BLOCK_ROWS], n
+                    ),
+                    range(0, labels.shape[0], BLOCK_ROWS),
+                )
+            )
+        agg = reduce(_combine_stats, partials)
+        # Zones without any valid pixel have no statistics, but a count of 0
+        agg = pd.DataFrame(agg).iloc[1:].replace([np.inf, -np.inf], np.nan)
+        agg.loc[agg["count"] == 0, ["sum", "mean", "m2"]] = np.nan
+
+        for stat in stats:
+            match stat:
+                case "std":
+                    results[stat] = np.sqrt(agg["m2"] / agg["count"])
+                case "range":
+                    results[stat] = agg["max"] - agg["min"]
+                case _:
+                    results[stat] = agg[stat]
+
+    df = pd.DataFrame(results, columns=stats).reindex(range(1, n + 1))
+    if "count" in df:
+        df["count"] = df["count"].fillna(0).astype(int)
+
+    return df.reset_index(drop=True)
+
 
 def bm_extract(
     roi: geopandas.GeoDataFrame,
-    product_id: Product,
-    date_range: datetime.date | List[datetime.date],
+    product_id: Product | str,
+    date_range: datetime.date | str | List[datetime.date | str] | pd.DatetimeIndex,
     bearer: str,
     aggfunc: str | List[str] = ["mean"],
     variable: Optional[str] = None,
@@ -31,16 +220,16 @@ def bm_extract(
     roi: geopandas.GeoDataFrame
         Region of interest
 
-    product_id: Product
-        NASA Black Marble product suite (VNP46) identifier. The available products are shown in following list:
+    product_id: Product | str
+        NASA Black Marble product suite (VNP46) identifier, as a ``Product`` or its name. The available products are shown in following list:
 
         - ``VNP46A1``: Daily (raw)
         - ``VNP46A2``: Daily (corrected)
         - ``VNP46A3``: Monthly
         - ``VNP46A4``: Annual
 
-    date_range: datetime.date | List[datetime.date]
-        Date range (single date or list of dates) for which to retrieve NASA Black Marble data.
+    date_range: datetime.date | str | List[datetime.date | str] | pandas.DatetimeIndex
+        Date range (single date or sequence of dates) for which to retrieve NASA Black Marble data. Any date or sequence of dates that ``pandas.to_datetime`` accepts, such as ``"2023-01-01"`` or ``pandas.date_range("2023-01-01", "2023-01-31")``.
 
     bearer: str
         NASA Earthdata Bearer token. Please refer to the `documentation <https://worldbank.github.io/blackmarblepy/examples/blackmarblepy.html#nasa-earthdata-bearer-token>`_.
@@ -56,7 +245,7 @@ def bm_extract(
         - For ``VNP46A3``, uses ``NearNadir_Composite_Snow_Free``.
         - For ``VNP46A4``, uses ``NearNadir_Composite_Snow_Free``.
 
-    quality_flag: List[int], default = [255]
+    quality_flag_rm: List[int], default = [255]
         Quality flag values to use to set values to ``NA``. Each pixel has a quality flag value, where low quality values can be removed. Values are set to ``NA`` for each value in ther ``quality_flag_rm`` vector.
 
         For ``VNP46A1`` and ``VNP46A2`` (daily data):
@@ -73,14 +262,16 @@ def bm_extract(
         - ``2``: Gap filled NTL based on historical data
         - ``255``: Fill value
 
+        For ``VNP46A3`` and ``VNP46A4``, these are the flags of the variable's own quality layer, e.g. ``NearNadir_Composite_Snow_Free_Quality`` for ``NearNadir_Composite_Snow_Free`` and its ``_Num`` and ``_Std`` layers. A variable without a quality layer is masked where its own raw values are in ``quality_flag_rm``.
+
     check_all_tiles_exist: bool, default=True
         Check whether all Black Marble nighttime light tiles exist for the region of interest. Sometimes not all tiles are available, so the full region of interest may not be covered. By default (True), it skips cases where not all tiles are available.
 
     file_directory: pathlib.Path, optional
-        Where to produce output. By default, the output will be procuded onto a temporary directory.
+        Directory to which download the HDF5 files, which are kept there and reused across runs. When ``None`` (default), the directory named by the ``BLACKMARBLE_CACHE`` environment variable is used if it is set, and a temporary directory deleted on return otherwise. An explicit ``file_directory`` always takes precedence over ``BLACKMARBLE_CACHE``.
 
-    file_directory_prefix: str, optional
-        Prefix
+    file_prefix: str, optional
+        Deprecated and ignored, since no file is written besides the downloaded HDF5 files. Passing it emits a ``DeprecationWarning``.
 
     file_skip_if_exists: bool, default=True
         Whether to skip downloading or extracting data if the data file for that date already exists.
@@ -93,6 +284,13 @@ def bm_extract(
     """
     if variable is None:
         variable = VARIABLE_DEFAULT.get(Product(product_id))
+    # Warned here rather than in bm_raster, so that the warning points at the caller
+    if file_prefix is not None:
+        warnings.warn(
+            "file_prefix is deprecated and ignored, since bm_extract writes no file besides the downloads",
+            DeprecationWarning,
+            stacklevel=2,
+        )
 
     ds = bm_raster(
         roi,
@@ -103,21 +301,62 @@ def bm_extract(
         quality_flag_rm,
         check_all_tiles_exist,
         file_directory,
-        file_prefix,
+        None,
         file_skip_if_exists,
     )
 
+    if isinstance(aggfunc, str):
+        aggfunc = aggfunc.split()
+
+    # All dates share the same grid, so label each pixel with its zone in a single
+    # rasterization. A pixel holds a single label, so overlapping features are burnt
+    # into separate grids, one per group of features that do not overlap each other,
+    # each covering only the window of its own features
+    labels = None
+    if set(aggfunc) <= GROUPBY_STATS:
+        group = _overlap_groups(roi.geometry)
+        if group.max(initial=0) < MAX_LABEL_GROUPS:
+            da = ds[variable].isel(time=0)
+            zones = np.arange(1, len(roi) + 1)
+            labels = [
+                (
+                    group == g,
+                    *_rasterize_window(
+                        roi.geometry[group == g],
+                        zones[group == g],
+                        transform(da),
+                        da.shape,
+                    ),
+                )
+                for g in range(group.max(initial=0) + 1)
+            ]
+
     results = []
     for t in ds["time"]:
         da = ds[variable].sel(time=t)
+        # Radiances do not need double precision; float32 halves the memory traffic of the reduction
+        values = da.values.astype(np.float32, copy=False)
 
-        zs = zonal_stats(
-            roi,
-            da.values,
-            nodata=np.nan,
-            affine=transform(da),
-            stats=aggfunc,
-        )
+        if labels is not None:
+            # Each feature takes its statistics from the grid of its own group
+            zs = pd.concat(
+                [
+                    _zonal_stats(grid, values[window], len(roi), aggfunc)[members]
+                    for members, window, grid in labels
+                ]
+            ).sort_index()
+        else:
+            # Only needed for statistics not covered by GROUPBY_STATS, or for many
+            # overlapping features
+            from rasterstats import zonal_stats
+
+            zs = zonal_stats(
+                roi,
+                values,
+                nodata=np.nan,
+                affine=transform(da),
+                stats=aggfunc,
+            )
         zs = pd.DataFrame(zs).add_prefix("ntl_")
         zs = pd.concat([roi, zs], axis=1)
         zs["date"] = t.values
@@ -1,6 +1,12 @@
 import datetime
+import logging
+import os
 import re
 import tempfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
 from pathlib import Path
 from typing import List, Optional
 
@@ -8,18 +14,21 @@ import geopandas
 import h5py
 import numpy as np
 import pandas as pd
-import rasterio
-import rioxarray
 import xarray as xr
-from pydantic import ConfigDict, validate_call
 from rasterio.transform import from_origin
 from rioxarray.merge import merge_arrays
+from shapely import clip_by_rect
 from shapely.geometry import mapping
 from tqdm.auto import tqdm
 
 from .download import BlackMarbleDownloader
 from .types import Product
 
+logger = logging.getLogger(__name__)
+
+# Suffixes of the observation count and standard deviation layers of monthly and annual products
+STATISTIC_SUFFIX = re.compile("_(?:Num|Std)")
+
 VARIABLE_DEFAULT = {
     Product.VNP46A1: "DNB_At_Sensor_Radiance_500m",
     Product.VNP46A2: "Gap_Filled_DNB_BRDF-Corrected_NTL",
@@ -28,16 +37,40 @@ VARIABLE_DEFAULT = {
 }
 
 
-def h5_to_geotiff(
+@lru_cache(maxsize=None)
+def _quality_flag_name(variable: str):
+    """Return the name of the quality flag layer of a monthly or annual variable"""
+    return f"{STATISTIC_SUFFIX.sub('', variable)}_Quality"
+
+
+@lru_cache(maxsize=None)
+def _quality_flag_table(quality_flag_rm: tuple):
+    """Return a lookup table of whether each of the 256 byte quality flags is removed"""
+    lut = np.zeros(256, dtype=bool)
+    lut[[v for v in quality_flag_rm if 0 <= v < 256]] = True
+    lut.flags.writeable = False
+    return lut
+
+
+def _quality_mask(qf: np.ndarray, quality_flag_rm: List[int]):
+    """Return whether each pixel is flagged with one of the quality flags to remove"""
+    if qf.dtype != np.uint8:
+        return np.isin(qf, quality_flag_rm)
+
+    # Quality flags are bytes, so look each pixel up in a table of all 256 values,
+    # built once per set of flags rather than once per tile
+    return _quality_flag_table(tuple(quality_flag_rm))[qf]
+
+
+def h5_to_dataarray(
     f: Path,
     /,
     variable: str = None,
     quality_flag_rm=[255],
-    output_directory: Path = None,
-    output_prefix: str = None,
+    roi=None,
 ):
     """
-    Convert HDF5 file to GeoTIFF for a selected (or default) variable from NASA Black Marble data
+    Read a selected (or default) variable from a NASA Black Marble HDF5 file into memory
 
     Parameters
     ----------
@@ -45,19 +78,24 @@ def h5_to_geotiff(
         H5DF filename
 
     variable: str, default = None
-        Variable to create GeoTIFF raster. Further information, pleae see the `NASA Black Marble User Guide <https://ladsweb.modaps.eosdis.nasa.gov/api/v2/content/archives/Document%20Archive/Science%20Data%20Product%20Documentation/VIIRS_Black_Marble_UG_v1.2_April_2021.pdf>`_ for `VNP46A1`, see Table 3; for `VNP46A2` see Table 6; for `VNP46A3` and `VNP46A4`, see Table 9. By default, it uses the following default variables:
+        Variable to read. Further information, pleae see the `NASA Black Marble User Guide <https://ladsweb.modaps.eosdis.nasa.gov/api/v2/content/archives/Document%20Archive/Science%20Data%20Product%20Documentation/VIIRS_Black_Marble_UG_v1.2_April_2021.pdf>`_ for `VNP46A1`, see Table 3; for `VNP46A2` see Table 6; for `VNP46A3` and `VNP46A4`, see Table 9. By default, it uses the following default variables:
 
         - For ``VNP46A1``, uses ``DNB_At_Sensor_Radiance_500m``
         - For ``VNP46A2``, uses ``Gap_Filled_DNB_BRDF-Corrected_NTL``
         - For ``VNP46A3``, uses ``NearNadir_Composite_Snow_Free``.
         - For ``VNP46A4``, uses ``NearNadir_Composite_Snow_Free``.
 
+    quality_flag_rm: List[int], default = [255]
+        Quality flag values of the pixels to set to ``NaN``
+
+    roi: shapely.Geometry, optional
+        Region of interest, in geographic coordinates (EPSG:4326). Only the window of the tile covering it is read.
+
     Returns
     ------
-    output_path: Path
-        Path to which export GeoTIFF file
+    xarray.DataArray
+        Scaled values of the variable, or ``None`` if the region of interest does not overlap the tile
     """
-    output_path = Path(output_directory, f.name).with_suffix(".tif")
     product_id = Product(f.stem.split(".")[0])
 
     if variable is None:
@@ -65,6 +103,9 @@ def h5_to_geotiff(
 
     with h5py.File(f, "r") as h5_data:
         attrs = h5_data.attrs
+        flip = False
+        # Whether the variable is masked on its own values, for lack of a quality layer
+        own_quality = False
 
         if product_id in [Product.VNP46A1, Product.VNP46A2]:
             dataset = h5_data["HDFEOS"]["GRIDS"]["VNP_Grid_DNB"]["Data Fields"][
@@ -86,61 +127,165 @@ def h5_to_geotiff(
                 variable
             ]
 
-            lat = h5_data["HDFEOS"]["GRIDS"]["VIIRS_Grid_DNB_2d"]["Data Fields"]["lat"]
-            lon = h5_data["HDFEOS"]["GRIDS"]["VIIRS_Grid_DNB_2d"]["Data Fields"]["lon"]
-            left, bottom, right, top = min(lon), min(lat), max(lon), max(lat)
-
-            if len(quality_flag_rm) > 0:
-                variable_short = variable
-                variable_short = re.sub("_Num", "", variable_short)
-                variable_short = re.sub("_Std", "", variable_short)
-
-                h5_names = list(
-                    h5_data["HDFEOS"]["GRIDS"]["VIIRS_Grid_DNB_2d"][
-                        "Data Fields"
-                    ].keys()
+            left, bottom, right, top = (
+                attrs.get("WestBoundingCoord"),
+                attrs.get("SouthBoundingCoord"),
+                attrs.get("EastBoundingCoord"),
+                attrs.get("NorthBoundingCoord"),
+            )
+            if None in (left, bottom, right, top):
+                # Fall back on the coordinate datasets, reduced with numpy rather than
+                # iterating over them element by element
+                lat = h5_data["HDFEOS"]["GRIDS"]["VIIRS_Grid_DNB_2d"]["Data Fields"][
+                    "lat"
+                ][:]
+                lon = h5_data["HDFEOS"]["GRIDS"]["VIIRS_Grid_DNB_2d"]["Data Fields"][
+                    "lon"
+                ][:]
+                # The coordinates locate pixel centres, half a pixel inside the edges
+                half_x = (lon.max() - lon.min()) / (lon.size - 1) / 2
+                half_y = (lat.max() - lat.min()) / (lat.size - 1) / 2
+                left, bottom, right, top = (
+                    lon.min() - half_x,
+                    lat.min() - half_y,
+                    lon.max() + half_x,
+                    lat.max() + half_y,
                 )
-                if (qf_name := f"{variable_short}_Quality") in h5_names:
-                    qf = h5_data["HDFEOS"]["GRIDS"]["VIIRS_Grid_DNB_2d"]["Data Fields"][
-                        qf_name
-                    ]
-                if variable in h5_names:
-                    qf = h5_data["HDFEOS"]["GRIDS"]["VIIRS_Grid_DNB_2d"]["Data Fields"][
-                        variable
-                    ]
-        # Extract data and attributes
-        scale_factor = dataset.attrs.get("scale_factor", 1)
-        offset = dataset.attrs.get("offset", 0)
-        data = scale_factor * dataset[:] + offset
-        qf = qf[:]
+                flip = lat[0] < lat[-1]
 
-        for val in quality_flag_rm:
-            data = np.where(qf == val, np.nan, data)
+            qf = h5_data["HDFEOS"]["GRIDS"]["VIIRS_Grid_DNB_2d"]["Data Fields"].get(
+                _quality_flag_name(variable)
+            )
+            if qf is None:
+                qf, own_quality = dataset, True
 
         # Get geospatial metadata (coordinates and attributes)
-        height, width = data.shape
-        transform = from_origin(
-            left,
-            top,
-            (right - left) / width,
-            (top - bottom) / height,
+        height, width = dataset.shape
+        res_x, res_y = (right - left) / width, (top - bottom) / height
+
+        # Window of the tile, with rows running from north to south, to read
+        row_start, row_stop, col_start, col_stop = 0, height, 0, width
+        if roi is not None:
+            part = clip_by_rect(roi, left, bottom, right, top)
+            if part.is_empty:
+                return None
+            minx, miny, maxx, maxy = part.bounds
+            col_start = max(int(np.floor((minx - left) / res_x)), 0)
+            col_stop = min(int(np.ceil((maxx - left) / res_x)), width)
+            row_start = max(int(np.floor((top - maxy) / res_y)), 0)
+            row_stop = min(int(np.ceil((top - miny) / res_y)), height)
+            if col_start >= col_stop or row_start >= row_stop:
+                return None
+
+        # Rows must run from north to south so that every tile shares the same grid
+        # orientation when merged
+        rows = (
+            np.s_[height - row_stop : height - row_start]
+            if flip
+            else np.s_[row_start:row_stop]
         )
+        window = np.s_[rows, col_start:col_stop]
 
-        with rasterio.open(
-            output_path,
-            "w",
-            driver="GTiff",
-            height=height,
-            width=width,
-            count=1,
-            dtype=data.dtype,
-            crs="EPSG:4326",
-            transform=transform,
-        ) as dst:
-            dst.write(data, 1)
-            dst.update_tags(**attrs)
+        # Extract data and attributes
+        scale_factor = float(np.ravel(dataset.attrs.get("scale_factor", 1))[0])
+        offset = float(np.ravel(dataset.attrs.get("offset", 0))[0])
+        fill_value = dataset.attrs.get("_FillValue")
+        # Read only the window, straight into a float32 buffer (HDF5 converts the type
+        # on read); radiances need no double precision
+        data = np.empty((row_stop - row_start, col_stop - col_start), dtype=np.float32)
+        dataset.read_direct(data, source_sel=window)
+        mask = (
+            data == np.float32(np.ravel(fill_value)[0])
+            if fill_value is not None
+            else np.zeros(data.shape, dtype=bool)
+        )
+        # The quality flags are only read when some of them are to be removed
+        if quality_flag_rm:
+            if own_quality:
+                # Masked on its own (still unscaled) values, which were just read
+                qf_data = data
+            else:
+                qf_data = np.empty(data.shape, dtype=qf.dtype)
+                qf.read_direct(qf_data, source_sel=window)
+            mask |= _quality_mask(qf_data, quality_flag_rm)
+
+        # Scale in place, then mask every removed pixel in a single pass
+        np.multiply(data, scale_factor, out=data)
+        np.add(data, offset, out=data)
+        data[mask] = np.nan
+        if flip:
+            data = np.ascontiguousarray(data[::-1])
+
+        tags = {k: v.decode() if isinstance(v, bytes) else v for k, v in attrs.items()}
+
+    da = xr.DataArray(
+        data[np.newaxis],
+        dims=("band", "y", "x"),
+        coords={
+            "band": [1],
+            "y": top - res_y * (np.arange(row_start, row_stop) + 0.5),
+            "x": left + res_x * (np.arange(col_start, col_stop) + 0.5),
+        },
+        attrs=tags,
+    )
+    return (
+        da.rio.write_crs("EPSG:4326")
+        .rio.write_transform(
+            from_origin(left + res_x * col_start, top - res_y * row_start, res_x, res_y)
+        )
+        .rio.write_nodata(np.nan)
+    )
 
-        return output_path
+
+def h5_to_geotiff(
+    f: Path,
+    /,
+    variable: str = None,
+    quality_flag_rm=[255],
+    output_directory: Path = None,
+    output_prefix: str = None,
+):
+    """
+    Convert HDF5 file to GeoTIFF for a selected (or default) variable from NASA Black Marble data
+
+    Parameters
+    ----------
+    f: Path
+        H5DF filename
+
+    variable: str, default = None
+        Variable to create GeoTIFF raster. See ``h5_to_dataarray``.
+
+    quality_flag_rm: List[int], default = [255]
+        Quality flag values of the pixels to set to ``NaN``. See ``h5_to_dataarray``.
+
+    output_directory: Path
+        Directory in which to write the GeoTIFF file
+
+    output_prefix: str, optional
+        Prefix of the GeoTIFF filename, which is otherwise named after the HDF5 file
+
+    Returns
+    ------
+    output_path: Path
+        Path to which export GeoTIFF file
+    """
+    output_path = Path(output_directory, f"{output_prefix or ''}{f.stem}.tif")
+
+    da = h5_to_dataarray(f, variable=variable, quality_flag_rm=quality_flag_rm)
+    da.rio.to_raster(
+        output_path,
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+        compress="zstd",
+        predictor=3,
+        zstd_level=1,
+        BIGTIFF="IF_SAFER",
+        num_threads="all_cpus",
+    )
+
+    return output_path
 
 
 def transform(da: xr.DataArray):
@@ -170,7 +315,10 @@ def _pivot_paths_by_date(paths: List[Path]):
     """
     results = {}
     for p in paths:
-        key = datetime.datetime.strptime(p.stem.split(".")[1], "A%Y%j").date()
+        # Acquisition date as "AYYYYDDD" (year and day of year); slicing it is much
+        # faster than strptime
+        s = p.stem.split(".")[1]
+        key = datetime.date(int(s[1:5]), 1, 1) + datetime.timedelta(int(s[5:8]) - 1)
         if key not in results:
             results[key] = []
         results[key].append(p)
@@ -178,11 +326,54 @@ def _pivot_paths_by_date(paths: List[Path]):
     return results
 
 
-@validate_call(config=ConfigDict(arbitrary_types_allowed=True))
+def _collate_tiles(
+    filenames: List[Path],
+    roi,
+    date: datetime.date,
+    variable: str,
+    quality_flag_rm: List[int],
+):
+    """Merge the tiles of a single date into one raster over the region of interest
+
+    Returns
+    -------
+    xarray.DataArray
+        Merged raster covering the region of interest or ``None`` if no tile is available for that date
+    """
+    if not filenames:
+        logger.debug(f"No data available on {date}")
+        return None
+
+    # Read each tile straight into memory, only over the window covering the part
+    # of the region of interest within it
+    da = [
+        tile
+        for f in filenames
+        if (
+            tile := h5_to_dataarray(
+                f,
+                variable=variable,
+                quality_flag_rm=quality_flag_rm,
+                roi=roi,
+            )
+        )
+        is not None
+    ]
+
+    if not da:
+        logger.debug(f"No tile overlaps the region of interest on {date}")
+        return None
+
+    ds = merge_arrays(da)
+    ds["time"] = pd.to_datetime(date)
+
+    return ds.squeeze()
+
+
 def bm_raster(
     gdf: geopandas.GeoDataFrame,
-    product_id: Product,
-    date_range: datetime.date | List[datetime.date],
+    product_id: Product | str,
+    date_range: datetime.date | str | List[datetime.date | str] | pd.DatetimeIndex,
     bearer: str,
     variable: Optional[str] = None,
     quality_flag_rm: List[int] = [255],
@@ -195,19 +386,19 @@ def bm_raster(
 
     Parameters
     ----------
-    roi: geopandas.GeoDataFrame
+    gdf: geopandas.GeoDataFrame
         Region of interest
 
-    product_id: Product
-        NASA Black Marble product suite (VNP46) identifier. The available products are shown in following list:
+    product_id: Product | str
+        NASA Black Marble product suite (VNP46) identifier, as a ``Product`` or its name. The available products are shown in following list:
 
         - ``VNP46A1``: Daily (raw)
         - ``VNP46A2``: Daily (corrected)
         - ``VNP46A3``: Monthly
         - ``VNP46A4``: Annual
 
-    date_range: datetime.date | List[datetime.date]
-        Date range (single date or list of dates) for which to retrieve NASA Black Marble data.
+    date_range: datetime.date | str | List[datetime.date | str] | pandas.DatetimeIndex
+        Date range (single date or sequence of dates) for which to retrieve NASA Black Marble data. Any date or sequence of dates that ``pandas.to_datetime`` accepts, such as ``"2023-01-01"`` or ``pandas.date_range("2023-01-01", "2023-01-31")``.
 
     bearer: str
         NASA Earthdata Bearer token. Please refer to the `documentation <https://worldbank.github.io/blackmarblepy/examples/blackmarblepy.html#nasa-earthdata-bearer-token>`_.
@@ -220,7 +411,7 @@ def bm_raster(
         - For ``VNP46A3``, uses ``NearNadir_Composite_Snow_Free``.
         - For ``VNP46A4``, uses ``NearNadir_Composite_Snow_Free``.
 
-    quality_flag: List[int], default = [255]
+    quality_flag_rm: List[int], default = [255]
         Quality flag values to use to set values to ``NA``. Each pixel has a quality flag value, where low quality values can be removed. Values are set to ``NA`` for each value in ther ``quality_flag_rm`` vector.
 
         For ``VNP46A1`` and ``VNP46A2`` (daily data):
@@ -237,14 +428,16 @@ def bm_raster(
         - ``2``: Gap filled NTL based on historical data
         - ``255``: Fill value
 
+        For ``VNP46A3`` and ``VNP46A4``, these are the flags of the variable's own quality layer, e.g. ``NearNadir_Composite_Snow_Free_Quality`` for ``NearNadir_Composite_Snow_Free`` and its ``_Num`` and ``_Std`` layers. A variable without a quality layer is masked where its own raw values are in ``quality_flag_rm``.
+
     check_all_tiles_exist: bool, default=True
         Check whether all Black Marble nighttime light tiles exist for the region of interest. Sometimes not all tiles are available, so the full region of interest may not be covered. By default (True), it skips cases where not all tiles are available.
 
     file_directory: pathlib.Path, optional
-        Where to produce output. By default, the output will be procuded onto a temporary directory.
+        Directory to which download the HDF5 files, which are kept there and reused across runs. When ``None`` (default), the directory named by the ``BLACKMARBLE_CACHE`` environment variable is used if it is set, and a temporary directory deleted on return otherwise. An explicit ``file_directory`` always takes precedence over ``BLACKMARBLE_CACHE``.
 
     file_prefix: str, optional
-        Prefix
+        Deprecated and ignored, since no file is written besides the downloaded HDF5 files. Passing it emits a ``DeprecationWarning``.
 
     file_skip_if_exists: bool, default=True
         Whether to skip downloading or extracting data if the data file for that date already exists.
@@ -252,61 +445,113 @@ def bm_raster(
     Returns
     -------
     xarray.Dataset
-        A Xarray dataset contaning a stack of nighttime lights rasters
+        A Xarray dataset contaning a stack of nighttime lights rasters. Pixels equal to the variable's ``_FillValue`` (no retrieval) are always set to ``NaN``, in addition to those removed by ``quality_flag_rm``.
+
+    Raises
+    ------
+    TypeError
+        If ``gdf`` is not a ``geopandas.GeoDataFrame``
+    ValueError
+        If ``product_id`` is not a NASA Black Marble product, or if no data covers the region of interest on any date
+    KeyError
+        If ``variable`` cannot be read on any date, e.g. as it is not a variable of the product
     """
-    # Validate and fix args
-    if not isinstance(quality_flag_rm, list):
-        quality_flag_rm = [quality_flag_rm]
-    if not isinstance(date_range, list):
-        date_range = [date_range]
+    # Validate and fix args with cheap explicit checks, rather than having pydantic
+    # inspect the whole GeoDataFrame on every call
+    if not isinstance(gdf, geopandas.GeoDataFrame):
+        raise TypeError(f"Expected a geopandas.GeoDataFrame, got {type(gdf).__name__}")
+    if file_prefix is not None:
+        warnings.warn(
+            "file_prefix is deprecated and ignored, since bm_raster writes no file besides the downloads",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+    product_id = Product(product_id)
+    # A single flag, a list, a tuple or an array of flags alike
+    quality_flag_rm = np.atleast_1d(quality_flag_rm).astype(int).tolist()
+    # Accept a single date or many, as dates, strings or a pandas date range alike
+    date_range = pd.to_datetime(np.atleast_1d(date_range)).date
 
     if variable is None:
         variable = VARIABLE_DEFAULT.get(product_id)
 
+    # Normalize straight into a set, dropping the dates falling in the same period
     match product_id:
         case Product.VNP46A3:
-            date_range = sorted(set([d.replace(day=1) for d in date_range]))
+            date_range = {d.replace(day=1) for d in date_range}
         case Product.VNP46A4:
-            date_range = sorted(set([d.replace(day=1, month=1) for d in date_range]))
+            date_range = {d.replace(day=1, month=1) for d in date_range}
+        case _:
+            date_range = set(date_range)
+    # Sorting upfront keeps the stack in time order without re-sorting it afterwards
+    date_range = sorted(date_range)
 
     # Download and construct Dataset
-    with file_directory if file_directory else tempfile.TemporaryDirectory() as d:
+    if file_directory is None and (cache := os.environ.get("BLACKMARBLE_CACHE")):
+        file_directory = Path(cache)
+    if file_directory is not None:
+        Path(file_directory).mkdir(parents=True, exist_ok=True)
+
+    with (
+        nullcontext(file_directory)
+        if file_directory
+        else tempfile.TemporaryDirectory(prefix="blackmarble_")
+    ) as d:
         downloader = BlackMarbleDownloader(bearer, d)
-        pathnames = downloader.download(gdf, product_id, date_range)
+        pathnames = downloader.download(
+            gdf, product_id, date_range, skip_if_exists=file_skip_if_exists
+        )
+
+        pathnames_by_date = _pivot_paths_by_date(pathnames)
+        # Tiles are in geographic coordinates
+        roi = gdf.to_crs("EPSG:4326").unary_union
 
-        dx = []
-        for date in tqdm(date_range, desc="COLLATING RESULTS | Processing..."):
-            filenames = _pivot_paths_by_date(pathnames).get(date)
+        errors = {}
 
+        def collate(date):
             try:
-                # Open each GeoTIFF file as a DataArray and store in a list
-                da = [
-                    rioxarray.open_rasterio(
-                        h5_to_geotiff(
-                            f,
-                            variable=variable,
-                            quality_flag_rm=quality_flag_rm,
-                            output_prefix=file_prefix,
-                            output_directory=d,
-                        ),
-                    )
-                    for f in filenames
-                ]
-                ds = merge_arrays(da)
-                ds = ds.rio.clip(gdf.geometry.apply(mapping), gdf.crs, drop=True)
-                ds["time"] = pd.to_datetime(date)
-
-                dx.append(ds.squeeze())
-            except TypeError:
-                continue
-
-        dx = filter(lambda item: item is not None, dx)
-
-        # Stack the individual dates along "time" dimension
+                return _collate_tiles(
+                    pathnames_by_date.get(date), roi, date, variable, quality_flag_rm
+                )
+            except (KeyError, OSError) as e:
+                # A corrupt or incomplete granule only invalidates its own date
+                logger.warning(f"Skipping {date}: {e}")
+                errors[date] = e
+                return None
+
+        # Dates are independent of each other, so collate them concurrently
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            dx = list(
+                tqdm(
+                    executor.map(collate, date_range),
+                    total=len(date_range),
+                    desc="COLLATING RESULTS | Processing...",
+                )
+            )
+
+        dx = [item for item in dx if item is not None]
+        if not dx:
+            if errors:
+                # Every date with data failed, e.g. on a variable missing from the product
+                raise errors[min(errors)]
+            raise ValueError(
+                f"No {product_id.value} data over the region of interest between {date_range[0]} and {date_range[-1]}"
+            )
+
+        # Stack the individual dates along "time" dimension, then clip the whole stack
+        # at once so that the region of interest is rasterized a single time
         ds = (
-            xr.concat(dx, dim="time", combine_attrs="drop_conflicts")
+            # Every date shares the same scalar coordinates (band, spatial_ref), so take
+            # them from the first one rather than comparing them across all dates
+            xr.concat(
+                dx,
+                dim="time",
+                coords="minimal",
+                compat="override",
+                combine_attrs="drop_conflicts",
+            )
+            .rio.clip(gdf.geometry.apply(mapping), gdf.crs, drop=True)
             .to_dataset(name=variable, promote_attrs=True)
-            .sortby("time")
             .drop(["band", "spatial_ref"])
         )
         if variable in VARIABLE_DEFAULT.values():
@@ -0,0 +1,128 @@
+import asyncio
+import datetime
+from pathlib import Path
+
+import geopandas
+import httpx
+import pytest
+from shapely.geometry import box
+
+from blackmarble import download
+from blackmarble.download import BlackMarbleDownloader
+
+MANIFEST = {"VNP46A3.A2023001.h00v00.001.2023032000000.h5": {"size": 1}}
+
+
+@pytest.fixture
+def responses():
+    return [httpx.Response(200, json=MANIFEST)]
+
+
+@pytest.fixture
+def queries(monkeypatch, responses):
+    queries = []
+
+    async def get_url(client, url, params):
+        queries.append(params)
+        return responses[len(queries) - 1]
+
+    monkeypatch.setattr(download, "get_url", get_url)
+    return queries
+
+
+@pytest.mark.parametrize(
+    "date,cached",
+    [
+        (datetime.date(2020, 1, 1), True),
+        (datetime.date.today().replace(day=1), False),
+    ],
+)
+def test_get_manifest_cache(queries, responses, date, cached):
+    responses.append(httpx.Response(200, json=MANIFEST))
+    downloader = BlackMarbleDownloader("bearer", Path("."))
+    gdf = geopandas.GeoDataFrame(geometry=[box(0, 0, 1, 1)], crs="EPSG:4326")
+
+    for _ in range(2):
+        asyncio.run(downloader.get_manifest(gdf, "VNP46A3", [date]))
+
+    # Only responses for dates past the publication lag are cached, and reused
+    assert len(queries) == (1 if cached else 2)
+    assert len(list(Path("manifest").glob("*.json"))) == (1 if cached else 0)
+    assert not list(Path("manifest").glob("*.part"))
+
+
+def test_get_manifest_failed_query_not_cached(queries, responses):
+    responses[:] = [
+        httpx.Response(503, json={"error": "Service Unavailable"}),
+        httpx.Response(200, json=MANIFEST),
+    ]
+    downloader = BlackMarbleDownloader("bearer", Path("."))
+    gdf = geopandas.GeoDataFrame(geometry=[box(0, 0, 1, 1)], crs="EPSG:4326")
+    date = datetime.date(2020, 1, 1)
+
+    with pytest.raises(ValueError):
+        asyncio.run(downloader.get_manifest(gdf, "VNP46A3", [date]))
+    assert not Path("manifest").exists()
+
+    # The next call queries again rather than reusing the error
+    manifest = asyncio.run(downloader.get_manifest(gdf, "VNP46A3", [date]))
+
+    assert len(queries) == 2
+    assert manifest.index.tolist() == list(MANIFEST)
+
+
+def test_download_deduplicates_granules(monkeypatch, queries, responses):
+    name = "VNP46A3.A2023001.h00v00.001.2023032000000.h5"
+    manifest = {name: {"name": name, "fileURL": f"/archive/{name}"}}
+    # Both tiles' queries return the same granule
+    responses[:] = [httpx.Response(200, json=manifest)] * 2
+    downloaded = []
+
+    async def _download_files(self, names, skip_if_exists):
+        downloaded.extend(names)
+        return [Path(Path(n).name) for n in names]
+
+    monkeypatch.setattr(BlackMarbleDownloader, "_download_files", _download_files)
+    downloader = BlackMarbleDownloader("bearer", Path("."))
+    gdf = geopandas.GeoDataFrame(geometry=[box(-175, 82, -165, 85)], crs="EPSG:4326")
+
+    pathnames = downloader.download(gdf, "VNP46A3", [datetime.date(2020, 1, 1)])
+
+    assert len(queries) == 2
+    assert downloaded == [f"/archive/{name}"]
+    assert pathnames == [Path(name)]
+
+
+class InterruptedStream(httpx.AsyncByteStream):
+    """Body whose transfer fails after its first chunk, on an error not retried"""
+
+    async def __aiter__(self):
+        yield b"partial"
+        raise OSError("No space left on device")
+
+
+@pytest.mark.parametrize("interrupted", [False, True])
+def test_download_file_leaves_no_partial_file(interrupted):
+    name = "VNP46A3.A2023001.h00v00.001.2023032000000.h5"
+
+    def handler(request):
+        if interrupted:
+            return httpx.Response(200, stream=InterruptedStream())
+        return httpx.Response(200, stream=httpx.ByteStream(b"granule"))
+
+    async def download_file():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await downloader._download_file(
+                client, asyncio.Semaphore(1), f"/archive/{name}"
+            )
+
+    downloader = BlackMarbleDownloader("bearer", Path("."))
+
+    if interrupted:
+        with pytest.raises(OSError):
+            asyncio.run(download_file())
+        assert not list(Path(".").iterdir())
+    else:
+        assert asyncio.run(download_file()) == Path(name)
+        assert [p.name for p in Path(".").iterdir()] == [name]
+        assert Path(name).read_bytes() == b"granule"
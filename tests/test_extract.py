@@ -0,0 +1,166 @@
+import datetime
+
+import geopandas
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from rasterstats import zonal_stats
+from shapely.geometry import box
+
+from blackmarble import extract
+from blackmarble.extract import _zonal_stats
+from blackmarble.raster import transform
+
+VARIABLE = "Gap_Filled_DNB_BRDF-Corrected_NTL"
+
+
+def patch_bm_raster(monkeypatch, values):
+    """Have bm_extract work on a single date of the given values, over pixels of 1 x 1"""
+    height, width = values.shape
+    ds = xr.Dataset(
+        {VARIABLE: (("time", "y", "x"), values[np.newaxis])},
+        coords={
+            "time": [np.datetime64("2023-01-01")],
+            "y": height - 0.5 - np.arange(height),
+            "x": np.arange(width) + 0.5,
+        },
+    )
+    monkeypatch.setattr(extract, "bm_raster", lambda *args, **kwargs: ds)
+    return ds[VARIABLE].isel(time=0)
+
+
+def expected_stats(roi, da, stats):
+    """Zonal statistics as computed by rasterstats"""
+    return pd.DataFrame(
+        zonal_stats(roi, da.values, nodata=np.nan, affine=transform(da), stats=stats)
+    ).add_prefix("ntl_")
+
+
+@pytest.mark.parametrize("block_rows", [1, 3, 512])
+def test_zonal_stats_std_bright_zone(monkeypatch, block_rows):
+    monkeypatch.setattr(extract, "BLOCK_ROWS", block_rows)
+    # A bright, nearly uniform zone, whose raw squares (~1e16) are not exact in float64
+    values = (1e8 + 8 * (np.arange(64) % 4)).astype(np.float32).reshape(8, 8)
+    labels = np.ones((8, 8), dtype=np.uint32)
+
+    df = _zonal_stats(labels, values, 1, ["mean", "std"])
+
+    assert df["mean"][0] == pytest.approx(values.astype(np.float64).mean(), rel=1e-12)
+    assert df["std"][0] == pytest.approx(values.astype(np.float64).std(), rel=1e-9)
+
+
+def test_zonal_stats_empty_zone():
+    values = np.array([[1, 2], [np.nan, 4]], dtype=np.float32)
+    labels = np.array([[1, 1], [2, 0]], dtype=np.uint32)
+
+    df = _zonal_stats(labels, values, 3, ["count", "mean", "std", "sum"])
+
+    # As in rasterstats, empty zones count 0 pixels and have no other statistic
+    assert df["count"].tolist() == [2, 0, 0]
+    assert df.loc[1:, ["mean", "std", "sum"]].isna().all().all()
+
+
+def test_bm_extract_overlapping_features(monkeypatch):
+    values = np.arange(100, dtype=np.float32).reshape(10, 10)
+    da = patch_bm_raster(monkeypatch, values)
+    # The second feature overlaps the first, and the third lies within both
+    roi = geopandas.GeoDataFrame(
+        geometry=[box(1, 1, 6, 6), box(3, 3, 9, 9), box(4, 4, 5, 5)],
+        crs="EPSG:4326",
+    )
+    stats = ["count", "sum", "mean"]
+
+    zs = extract.bm_extract(
+        roi, "VNP46A2", datetime.date(2023, 1, 1), "bearer", aggfunc=stats
+    )
+
+    pd.testing.assert_frame_equal(
+        zs[[f"ntl_{stat}" for stat in stats]],
+        expected_stats(roi, da, stats),
+        check_dtype=False,
+        check_like=True,
+    )
+
+
+@pytest.mark.parametrize("block_rows", [1, 512])
+@pytest.mark.parametrize("median", [True, False])
+def test_bm_extract_matches_rasterstats(monkeypatch, block_rows, median):
+    monkeypatch.setattr(extract, "BLOCK_ROWS", block_rows)
+    rng = np.random.default_rng(0)
+    values = rng.gamma(2, 10, (12, 12)).astype(np.float32)
+    values[rng.random((12, 12)) < 0.2] = np.nan
+    values[:3, :3] = np.nan
+    da = patch_bm_raster(monkeypatch, values)
+    affine = transform(da)
+    # Centre of the pixel in row 8, column 5, and of the all-NaN top-left corner
+    x, y = affine * (5.5, 8.5)
+    nan_x, nan_y = affine * (1.5, 1.5)
+    roi = geopandas.GeoDataFrame(
+        geometry=[
+            box(1, 1, 11, 7),
+            box(x - 0.1, y - 0.1, x + 0.1, y + 0.1),
+            box(nan_x - 0.5, nan_y - 0.5, nan_x + 0.5, nan_y + 0.5),
+            box(20, 20, 21, 21),
+        ],
+        crs="EPSG:4326",
+    )
+    stats = ["count", "min", "max", "mean", "sum", "std", "range"]
+    if median:
+        stats.append("median")
+
+    zs = extract.bm_extract(
+        roi, "VNP46A2", datetime.date(2023, 1, 1), "bearer", aggfunc=stats
+    )
+
+    expected = expected_stats(roi, da, stats)
+    # A single-pixel zone, and two empty zones: one over NaN pixels, one off the raster
+    assert expected["ntl_count"].tolist()[1:] == [1, 0, 0]
+    pd.testing.assert_frame_equal(
+        zs[[f"ntl_{stat}" for stat in stats]],
+        expected,
+        check_dtype=False,
+        check_like=True,
+        rtol=1e-5,
+    )
+
+
+@pytest.mark.parametrize("max_label_groups", [1, 8, 64])
+def test_bm_extract_many_overlapping_features(monkeypatch, max_label_groups):
+    monkeypatch.setattr(extract, "MAX_LABEL_GROUPS", max_label_groups)
+    rng = np.random.default_rng(1)
+    values = rng.gamma(2, 10, (40, 40)).astype(np.float32)
+    da = patch_bm_raster(monkeypatch, values)
+    # Buffers around nearby points, overlapping in many groups, some past the edges
+    points = geopandas.points_from_xy(*rng.uniform(-2, 42, (2, 60)))
+    roi = geopandas.GeoDataFrame(
+        geometry=points.buffer(rng.uniform(1, 12, 60)), crs="EPSG:4326"
+    )
+    stats = ["count", "sum", "mean", "std"]
+
+    zs = extract.bm_extract(
+        roi, "VNP46A2", datetime.date(2023, 1, 1), "bearer", aggfunc=stats
+    )
+
+    assert extract._overlap_groups(roi.geometry).max() + 1 > 8
+    pd.testing.assert_frame_equal(
+        zs[[f"ntl_{stat}" for stat in stats]],
+        expected_stats(roi, da, stats),
+        check_dtype=False,
+        check_like=True,
+        rtol=1e-5,
+    )
+
+
+def test_bm_extract_file_prefix_deprecated(monkeypatch):
+    patch_bm_raster(monkeypatch, np.ones((4, 4), dtype=np.float32))
+    roi = geopandas.GeoDataFrame(geometry=[box(1, 1, 3, 3)], crs="EPSG:4326")
+
+    with pytest.warns(DeprecationWarning, match="file_prefix") as record:
+        zs = extract.bm_extract(
+            roi, "VNP46A2", datetime.date(2023, 1, 1), "bearer", file_prefix="x_"
+        )
+
+    # Pointing at the caller, once
+    assert [w.filename for w in record if "file_prefix" in str(w.message)] == [__file__]
+    assert zs["ntl_mean"].tolist() == [1]
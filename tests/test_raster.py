@@ -0,0 +1,275 @@
+import datetime
+from pathlib import Path
+
+import geopandas
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+from blackmarble import raster
+from blackmarble.raster import h5_to_dataarray, h5_to_geotiff
+
+DAILY = "HDFEOS/GRIDS/VNP_Grid_DNB/Data Fields"
+MONTHLY = "HDFEOS/GRIDS/VIIRS_Grid_DNB_2d/Data Fields"
+SIZE = 10
+
+
+def write_daily(name="VNP46A2.A2023001.h00v00.001.2023002000000.h5"):
+    """Write a 10x10 daily granule over (0, 0, 10, 10), with one fill value and one removed flag"""
+    f = Path(name)
+    values = np.arange(SIZE * SIZE, dtype=np.uint16).reshape(SIZE, SIZE)
+    values[0, 0] = 65535
+    qf = np.zeros((SIZE, SIZE), dtype=np.uint8)
+    qf[1, 1] = 255
+    with h5py.File(f, "w") as h5:
+        h5.attrs.update(
+            WestBoundingCoord=0.0,
+            SouthBoundingCoord=0.0,
+            EastBoundingCoord=10.0,
+            NorthBoundingCoord=10.0,
+        )
+        ds = h5.create_dataset(
+            f"{DAILY}/Gap_Filled_DNB_BRDF-Corrected_NTL", data=values
+        )
+        ds.attrs.update(scale_factor=0.1, offset=0.0, _FillValue=np.uint16(65535))
+        h5.create_dataset(f"{DAILY}/Mandatory_Quality_Flag", data=qf)
+    return f
+
+
+def write_monthly(
+    values, quality=None, ascending=True, variable="NearNadir_Composite_Snow_Free"
+):
+    """Write a 10x10 monthly granule over (0, 0, 10, 10), located only by its lat/lon centres"""
+    f = Path("VNP46A3.A2023001.h00v00.001.2023032000000.h5")
+    lat = np.arange(SIZE) + 0.5
+    with h5py.File(f, "w") as h5:
+        h5.create_dataset(f"{MONTHLY}/lat", data=lat if ascending else lat[::-1])
+        h5.create_dataset(f"{MONTHLY}/lon", data=np.arange(SIZE) + 0.5)
+        h5.create_dataset(f"{MONTHLY}/{variable}", data=values)
+        if quality is not None:
+            h5.create_dataset(f"{MONTHLY}/{variable}_Quality", data=quality)
+    return f
+
+
+def expected_daily():
+    expected = np.arange(SIZE * SIZE, dtype=np.float32).reshape(SIZE, SIZE) * 0.1
+    expected[0, 0] = expected[1, 1] = np.nan
+    return expected
+
+
+def test_h5_to_dataarray_daily():
+    da = h5_to_dataarray(write_daily())
+
+    assert da.dtype == np.float32
+    np.testing.assert_allclose(da.values[0], expected_daily(), rtol=1e-6)
+    np.testing.assert_allclose(da["x"], np.arange(SIZE) + 0.5)
+    np.testing.assert_allclose(da["y"], SIZE - 0.5 - np.arange(SIZE))
+    assert da.rio.transform().to_gdal() == (0.0, 1.0, 0.0, 10.0, 0.0, -1.0)
+    assert da.rio.crs.to_epsg() == 4326
+
+
+def test_h5_to_dataarray_daily_window():
+    da = h5_to_dataarray(write_daily(), roi=box(2.2, 3.4, 4.6, 5.1))
+
+    # Columns 2 to 4, and rows 4 to 6 counted from the north edge
+    np.testing.assert_allclose(da.values[0], expected_daily()[4:7, 2:5], rtol=1e-6)
+    np.testing.assert_allclose(da["x"], [2.5, 3.5, 4.5])
+    np.testing.assert_allclose(da["y"], [5.5, 4.5, 3.5])
+    assert da.rio.transform().to_gdal() == (2.0, 1.0, 0.0, 6.0, 0.0, -1.0)
+
+
+def test_h5_to_dataarray_outside_roi():
+    assert h5_to_dataarray(write_daily(), roi=box(20, 20, 30, 30)) is None
+
+
+@pytest.mark.parametrize("ascending", [True, False])
+def test_h5_to_dataarray_coordinates_fallback(ascending):
+    # Rows are stored from south to north when latitudes ascend
+    north_up = np.arange(SIZE * SIZE, dtype=np.uint16).reshape(SIZE, SIZE)
+    values = north_up[::-1] if ascending else north_up
+    f = write_monthly(values, ascending=ascending)
+
+    da = h5_to_dataarray(f, quality_flag_rm=[])
+
+    # Centres are half a pixel inside the padded bounds, north up
+    np.testing.assert_allclose(da.values[0], north_up)
+    np.testing.assert_allclose(da["x"], np.arange(SIZE) + 0.5)
+    np.testing.assert_allclose(da["y"], SIZE - 0.5 - np.arange(SIZE))
+    assert da.rio.transform().to_gdal() == (0.0, 1.0, 0.0, 10.0, 0.0, -1.0)
+
+    da = h5_to_dataarray(f, quality_flag_rm=[], roi=box(2.2, 3.4, 4.6, 5.1))
+
+    np.testing.assert_allclose(da.values[0], north_up[4:7, 2:5])
+    np.testing.assert_allclose(da["y"], [5.5, 4.5, 3.5])
+
+
+def test_h5_to_geotiff_prefix():
+    path = h5_to_geotiff(write_daily(), output_directory=Path("."), output_prefix="x_")
+
+    assert path == Path("x_VNP46A2.A2023001.h00v00.001.2023002000000.tif")
+    assert path.exists()
+
+
+def test_bm_raster_file_prefix_deprecated(monkeypatch):
+    f = write_daily()
+    monkeypatch.setattr(
+        raster.BlackMarbleDownloader, "download", lambda self, *args, **kwargs: [f]
+    )
+    gdf = geopandas.GeoDataFrame(geometry=[box(2, 2, 8, 8)], crs="EPSG:4326")
+
+    with pytest.warns(DeprecationWarning, match="file_prefix") as record:
+        ds = raster.bm_raster(
+            gdf,
+            "VNP46A2",
+            datetime.date(2023, 1, 1),
+            "bearer",
+            file_directory=Path("."),
+            file_prefix="x_",
+        )
+
+    np.testing.assert_allclose(
+        ds["Gap_Filled_DNB_BRDF-Corrected_NTL"].values[0],
+        expected_daily()[2:8, 2:8],
+        rtol=1e-6,
+    )
+    # Pointing at the caller, once
+    assert [w.filename for w in record if "file_prefix" in str(w.message)] == [__file__]
+
+
+def test_h5_to_dataarray_quality_layer():
+    values = np.full((SIZE, SIZE), 10, dtype=np.uint16)
+    values[0, 0] = 2
+    quality = np.zeros((SIZE, SIZE), dtype=np.uint8)
+    quality[0, 1] = 2
+    f = write_monthly(values, quality=quality, ascending=False)
+
+    da = h5_to_dataarray(f, quality_flag_rm=[2])
+
+    # Masked on the quality layer, not on the variable's own values
+    assert not np.isnan(da.values[0, 0, 0])
+    assert np.isnan(da.values[0, 0, 1])
+    assert np.isnan(da.values).sum() == 1
+
+
+def test_h5_to_dataarray_own_quality():
+    values = np.full((SIZE, SIZE), 10, dtype=np.uint16)
+    values[0, 0] = 2
+    f = write_monthly(values, ascending=False, variable="AllAngle_Composite_Snow_Free")
+
+    da = h5_to_dataarray(
+        f, variable="AllAngle_Composite_Snow_Free", quality_flag_rm=[2]
+    )
+
+    # Without a quality layer, the variable is masked on its own values
+    assert np.isnan(da.values[0, 0, 0])
+    assert np.isnan(da.values).sum() == 1
+
+
+def test_bm_raster_bad_product_id():
+    gdf = geopandas.GeoDataFrame(geometry=[box(2, 2, 8, 8)], crs="EPSG:4326")
+
+    with pytest.raises(ValueError):
+        raster.bm_raster(gdf, "VNP46A9", datetime.date(2023, 1, 1), "bearer")
+
+
+def test_bm_raster_not_a_geodataframe():
+    with pytest.raises(TypeError):
+        raster.bm_raster(
+            box(2, 2, 8, 8), "VNP46A2", datetime.date(2023, 1, 1), "bearer"
+        )
+
+
+@pytest.mark.parametrize(
+    "date_range",
+    ["2023-01-01", ["2023-01-01"], pd.date_range("2023-01-01", periods=1)],
+)
+def test_bm_raster_date_range(monkeypatch, date_range):
+    f = write_daily()
+    requested = []
+
+    def download(self, gdf, product_id, date_range, skip_if_exists):
+        requested.extend(date_range)
+        return [f]
+
+    monkeypatch.setattr(raster.BlackMarbleDownloader, "download", download)
+    gdf = geopandas.GeoDataFrame(geometry=[box(2, 2, 8, 8)], crs="EPSG:4326")
+
+    raster.bm_raster(gdf, "VNP46A2", date_range, "bearer", file_directory=Path("."))
+
+    assert requested == [datetime.date(2023, 1, 1)]
+
+
+def test_bm_raster_keeps_file_directory(monkeypatch):
+    f = write_daily()
+    monkeypatch.setattr(
+        raster.BlackMarbleDownloader, "download", lambda self, *args, **kwargs: [f]
+    )
+    gdf = geopandas.GeoDataFrame(geometry=[box(2, 2, 8, 8)], crs="EPSG:4326")
+
+    raster.bm_raster(
+        gdf, "VNP46A2", datetime.date(2023, 1, 1), "bearer", file_directory=Path(".")
+    )
+
+    # The caller's directory is left as it was: the granule stays, nothing is added
+    assert sorted(Path(".").iterdir()) == [f]
+
+
+@pytest.mark.parametrize(
+    "quality_flag_rm", [255, [255], (255, 2), np.array([255]), np.array([], int)]
+)
+def test_bm_raster_quality_flag_rm(monkeypatch, quality_flag_rm):
+    f = write_daily()
+    monkeypatch.setattr(
+        raster.BlackMarbleDownloader, "download", lambda self, *args, **kwargs: [f]
+    )
+    gdf = geopandas.GeoDataFrame(geometry=[box(0, 0, 10, 10)], crs="EPSG:4326")
+
+    ds = raster.bm_raster(
+        gdf,
+        "VNP46A2",
+        datetime.date(2023, 1, 1),
+        "bearer",
+        quality_flag_rm=quality_flag_rm,
+        file_directory=Path("."),
+    )
+
+    # The pixel flagged 255 is removed unless no flag is
+    values = ds["Gap_Filled_DNB_BRDF-Corrected_NTL"].values[0]
+    assert np.isnan(values[1, 1]) == (255 in np.atleast_1d(quality_flag_rm))
+    assert np.isnan(values).sum() == 1 + np.isnan(values[1, 1])
+
+
+def test_bm_raster_bad_variable(monkeypatch):
+    f = write_daily()
+    monkeypatch.setattr(
+        raster.BlackMarbleDownloader, "download", lambda self, *args, **kwargs: [f]
+    )
+    gdf = geopandas.GeoDataFrame(geometry=[box(2, 2, 8, 8)], crs="EPSG:4326")
+
+    with pytest.raises(KeyError, match="NoSuchVariable"):
+        raster.bm_raster(
+            gdf,
+            "VNP46A2",
+            datetime.date(2023, 1, 1),
+            "bearer",
+            variable="NoSuchVariable",
+            file_directory=Path("."),
+        )
+
+
+def test_bm_raster_no_data(monkeypatch):
+    monkeypatch.setattr(
+        raster.BlackMarbleDownloader, "download", lambda self, *args, **kwargs: []
+    )
+    gdf = geopandas.GeoDataFrame(geometry=[box(2, 2, 8, 8)], crs="EPSG:4326")
+
+    with pytest.raises(ValueError, match="No VNP46A2 data"):
+        raster.bm_raster(
+            gdf,
+            "VNP46A2",
+            datetime.date(2023, 1, 1),
+            "bearer",
+            file_directory=Path("."),
+        )